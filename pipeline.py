@@ -1,13 +1,19 @@
 import os
-import requests
-import pandas as pd
+import asyncio
+import aiohttp
+import csv
 import time
-import json
+import pandas as pd
+import orjson
+import zstandard as zstd
+from collections import deque
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2 import Error
-from typing import List, Dict, Optional
+import psycopg
+from psycopg import Error
+from psycopg.conninfo import conninfo_to_dict
+from typing import List, Dict, Optional, Tuple
 
 # Load environment variables
 load_dotenv()
@@ -18,7 +24,8 @@ SUPABASE_HOST = os.getenv('SUPABASE_HOST')
 SUPABASE_DATABASE = os.getenv('SUPABASE_DATABASE', 'postgres')
 SUPABASE_USER = os.getenv('SUPABASE_USER')
 SUPABASE_PASSWORD = os.getenv('SUPABASE_PASSWORD')
-SUPABASE_PORT = 6543
+SUPABASE_PORT = int(os.getenv('SUPABASE_PORT', 6543))
+SUPABASE_POOLER_PORT = 6543  # Supavisor transaction pooling; backends are shared between clients
 SUPABASE_URL = os.getenv('SUPABASE_URL')  # Direct connection URL (alternative to individual params)
 
 # Constants
@@ -26,59 +33,136 @@ BASE_URL = "https://www.alphavantage.co/query"
 FUNCTION = "INSIDER_TRANSACTIONS"
 SYMBOLS = ["IBM", "AAPL", "MSFT", "GOOGL"]
 CUTOFF_DAYS = 2 * 365  # 2 years
+RATE_LIMIT_REQUESTS = 5  # Alpha Vantage free tier: 5 requests per minute
+RATE_LIMIT_PERIOD = 60  # seconds
+# One in-flight request per symbol at most; more than the per-window quota can never help
+MAX_CONCURRENT_REQUESTS = min(len(SYMBOLS), RATE_LIMIT_REQUESTS)
+MIN_CONCURRENT_REQUESTS = 1
+LATENCY_TARGET = 2.0  # seconds; faster responses let concurrency grow again
+MAX_RETRIES = 3  # per symbol, on 429/5xx
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(sock_connect=3.05, sock_read=27)
+BULK_LOAD_THRESHOLD = 500  # rows; larger loads go through COPY instead of INSERT
+CACHE_DIR = '.cache'  # zstd-compressed raw API responses, one file per symbol
+CACHE_TTL = 6 * 60 * 60  # seconds; reruns within this window skip the API call
+_table_verified = False  # DDL only needs to run once per process
+COLUMNS = ['symbol', 'date', 'executive', 'title', 'type', 'transaction', 'shares', 'price']
+TRANSACTION_FIELDS = {  # Alpha Vantage field -> COLUMNS name
+    'transaction_date': 'date',
+    'executive': 'executive',
+    'executive_title': 'title',
+    'security_type': 'type',
+    'acquisition_or_disposal': 'transaction',
+    'shares': 'shares',
+    'share_price': 'price'
+}
+
+class AdaptiveRateLimiter:
+    """Pace API calls with a sliding request window, rate-limit headers and AIMD concurrency"""
+    
+    def __init__(self, requests_per_period: int, period: float,
+                 min_concurrency: float, max_concurrency: float, latency_target: float):
+        self.requests_per_period = requests_per_period
+        self.period = period
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.concurrency = float(max_concurrency)
+        self._timestamps = deque()
+        self._resume_at = 0.0
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._window_lock = asyncio.Lock()
+    
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.concurrency))
+            self._in_flight += 1
+        await self.wait_if_throttled()
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+    
+    async def wait_if_throttled(self):
+        """Block until the request fits in the window and any header-driven pause is over"""
+        async with self._window_lock:
+            while True:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.period:
+                    self._timestamps.popleft()
+                
+                if now < self._resume_at:
+                    delay = self._resume_at - now
+                elif len(self._timestamps) >= self.requests_per_period:
+                    delay = self._timestamps[0] + self.period - now
+                else:
+                    self._timestamps.append(now)
+                    return
+                await asyncio.sleep(delay)
+    
+    def record_response(self, status: int, headers, latency: float):
+        """Adjust concurrency and pacing from a response (AIMD on throttling/server errors)"""
+        if self.is_throttled(status):
+            self.concurrency = max(self.min_concurrency, self.concurrency * 0.5)
+            retry_after = headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                self._pause_until(time.monotonic() + int(retry_after))
+            else:
+                self._pause_until(time.monotonic() + self.period / self.requests_per_period)
+            return
+        
+        if latency < self.latency_target:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 0.5)
+        
+        # Quota nearly used up: hold off until the oldest request leaves the window
+        remaining = headers.get('X-RateLimit-Remaining', '')
+        if remaining.isdigit() and int(remaining) < 0.2 * self.requests_per_period:
+            oldest = self._timestamps[0] if self._timestamps else time.monotonic()
+            self._pause_until(oldest + self.period)
+    
+    @staticmethod
+    def is_throttled(status: int) -> bool:
+        return status == 429 or status >= 500
+    
+    def _pause_until(self, resume_at: float):
+        self._resume_at = max(self._resume_at, resume_at)
 
 class ETLPipeline:
     def __init__(self):
         self.connection = None
-        self.raw_data = []
         self.processed_data = []
         
     def extract(self) -> bool:
-        """Fetch data from Alpha Vantage API for all symbols"""
+        """Fetch and clean data from Alpha Vantage API for all symbols concurrently"""
         print("\n=== EXTRACTION PHASE ===")
+        if not API_KEY:
+            print("API_KEY is not set")
+            return False
+        
         success = True
+        cutoff_date = datetime.now() - timedelta(days=CUTOFF_DAYS)
+        results = asyncio.run(self._fetch_all(cutoff_date))
         
-        for symbol in SYMBOLS:
-            print(f"Fetching data for {symbol}...")
-            data = self._fetch_api_data(symbol)
-            
-            if data:
-                self.raw_data.append({
-                    'symbol': symbol,
-                    'data': data
-                })
+        for symbol, fetched in zip(SYMBOLS, results):
+            if fetched:
                 print(f"Successfully fetched data for {symbol}")
             else:
                 print(f"Failed to fetch data for {symbol}")
                 success = False
-            
-            time.sleep(12)  # Respect API rate limits
         
         return success
     
     def transform(self) -> bool:
-        """Process and clean the extracted data"""
+        """Report on the cleaned data; each symbol is transformed as soon as it is fetched"""
         print("\n=== TRANSFORMATION PHASE ===")
-        if not self.raw_data:
-            print("No data to transform")
-            return False
-        
-        cutoff_date = datetime.now() - timedelta(days=CUTOFF_DAYS)
-        
-        for symbol_data in self.raw_data:
-            symbol = symbol_data['symbol']
-            transactions = symbol_data['data'].get('data', [])
-            
-            for transaction in transactions:
-                processed = self._process_transaction(transaction, symbol, cutoff_date)
-                if processed:
-                    self.processed_data.append(processed)
-        
         print(f"Processed {len(self.processed_data)} total transactions")
         return len(self.processed_data) > 0
     
     def load(self) -> bool:
-        """Load data into PostgreSQL database"""
+        """Load data into PostgreSQL database in a single transaction"""
+        global _table_verified
         print("\n=== LOADING PHASE ===")
         if not self.processed_data:
             print("No data to load")
@@ -86,92 +170,171 @@ class ETLPipeline:
         
         try:
             self._establish_db_connection()
-            self._create_table_if_not_exists()
             
-            df = pd.DataFrame(self.processed_data)
-            self._insert_data_to_db(df)
-            self._save_to_csv(df)
+            # One cursor for the whole load phase
+            with self.connection.cursor() as cursor:
+                self._configure_load_transaction(cursor)
+                self._create_table_if_not_exists(cursor)
+                self._insert_data_to_db(cursor)
+            self.connection.commit()
+            _table_verified = True
+            
+            self._save_to_csv()
             return True
             
         except Error as e:
+            if self.connection and not self.connection.closed:
+                self.connection.rollback()
             print(f"Database error: {e}")
             return False
         finally:
             self._close_db_connection()
     
-    def _fetch_api_data(self, symbol: str) -> Optional[Dict]:
-        """Fetch insider transactions for a given symbol"""
+    async def _fetch_all(self, cutoff_date: datetime) -> List[bool]:
+        """Fetch all symbols over one session, paced by the API rate limit"""
+        self._limiter = AdaptiveRateLimiter(
+            RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD,
+            MIN_CONCURRENT_REQUESTS, MAX_CONCURRENT_REQUESTS, LATENCY_TARGET
+        )
+        # Shared keep-alive pool sized to the limiter's concurrency ceiling
+        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, limit_per_host=MAX_CONCURRENT_REQUESTS)
+        
+        async with aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT) as session:
+            return await asyncio.gather(*[
+                self._extract_and_transform_symbol(session, symbol, cutoff_date) for symbol in SYMBOLS
+            ])
+    
+    async def _extract_and_transform_symbol(self, session: aiohttp.ClientSession, symbol: str,
+                                            cutoff_date: datetime) -> bool:
+        """Fetch one symbol and clean it straight away, so its raw JSON is dropped immediately"""
+        data = await self._fetch_async(session, symbol)
+        if not data:
+            return False
+        
+        df = self._process_transactions(data.get('data', []), symbol, cutoff_date)
+        self.processed_data.extend(df[COLUMNS].itertuples(index=False, name=None))
+        return True
+    
+    async def _fetch_async(self, session: aiohttp.ClientSession, symbol: str) -> Optional[Dict]:
+        """Fetch insider transactions for a given symbol, served from the disk cache when fresh"""
+        cached = self._read_cache(symbol)
+        if cached is not None:
+            print(f"Using cached data for {symbol}")
+            return cached
+        
         params = {
             "function": FUNCTION,
             "symbol": symbol,
             "apikey": API_KEY
         }
         
+        for attempt in range(MAX_RETRIES + 1):
+            async with self._limiter:
+                print(f"Fetching data for {symbol}...")
+                started = time.monotonic()
+                try:
+                    async with session.get(BASE_URL, params=params) as response:
+                        self._limiter.record_response(
+                            response.status, response.headers, time.monotonic() - started
+                        )
+                        if self._limiter.is_throttled(response.status) and attempt < MAX_RETRIES:
+                            print(f"HTTP {response.status} for {symbol}, backing off and retrying...")
+                            continue
+                        response.raise_for_status()
+                        body = await response.read()
+                        data = orjson.loads(body)
+                except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+                    print(f"API Error for {symbol}: {e}")
+                    return None
+                
+                # Throttle notices arrive as 200s without 'data'; never cache those
+                if 'data' in data:
+                    self._write_cache(symbol, body)
+                return data
+    
+    def _cache_path(self, symbol: str) -> str:
+        return os.path.join(CACHE_DIR, f'{symbol}.json.zst')
+    
+    def _read_cache(self, symbol: str) -> Optional[Dict]:
+        """Return the cached response for a symbol if it is younger than CACHE_TTL"""
+        path = self._cache_path(symbol)
         try:
-            response = requests.get(BASE_URL, params=params)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"API Error for {symbol}: {e}")
+            if time.time() - os.path.getmtime(path) > CACHE_TTL:
+                return None
+            with open(path, 'rb') as f, zstd.ZstdDecompressor().stream_reader(f) as reader:
+                return orjson.loads(reader.read())
+        except (OSError, zstd.ZstdError, orjson.JSONDecodeError):
             return None
-        
-    def _safe_float(self, value, default=0.0):  # Add self as first parameter
-        try:
-            return float(value) if value else default
-        except (ValueError, TypeError):
-            return default
     
-    def _process_transaction(self, transaction: Dict, symbol: str, cutoff_date: datetime) -> Optional[Dict]:
-        if not transaction.get('transaction_date'):
-            return None
-            
+    def _write_cache(self, symbol: str, body: bytes):
+        """Store the raw response bytes compressed, keyed by symbol"""
         try:
-            trans_date = datetime.strptime(transaction['transaction_date'], '%Y-%m-%d')
-        except ValueError:
-            return None
-            
-        if trans_date < cutoff_date:
-            return None
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(self._cache_path(symbol), 'wb') as f:
+                f.write(zstd.ZstdCompressor(level=3).compress(body))
+        except OSError as e:
+            print(f"Could not cache response for {symbol}: {e}")
         
-        # Safe conversions with fallbacks
-        shares = self._safe_float(transaction.get('shares'))
-        price = self._safe_float(transaction.get('share_price'))
+    def _process_transactions(self, transactions: List[Dict], symbol: str, cutoff_date: datetime) -> pd.DataFrame:
+        """Clean one symbol's transactions in bulk, dropping undated or out-of-range rows"""
+        df = pd.DataFrame(transactions).reindex(columns=list(TRANSACTION_FIELDS)).rename(columns=TRANSACTION_FIELDS)
         
-        return {
-            'symbol': symbol,
-            'date': transaction['transaction_date'],
-            'executive': transaction.get('executive', ''),
-            'title': transaction.get('executive_title', ''),
-            'type': transaction.get('security_type', ''),
-            'transaction': transaction.get('acquisition_or_disposal', ''),
-            'shares': shares,
-            'price': price
-    }
-
-
+        # Unparseable dates become NaT, which never passes the cutoff comparison
+        trans_date = pd.to_datetime(df['date'], errors='coerce', format='%Y-%m-%d')
+        keep = trans_date >= cutoff_date
+        df = df[keep]
+        
+        # Safe conversions with fallbacks; dates stay parsed so they are sent as DATE values
+        return df.fillna({'executive': '', 'title': '', 'type': '', 'transaction': ''}).assign(
+            symbol=symbol,
+            date=trans_date[keep].dt.date,
+            shares=pd.to_numeric(df['shares'], errors='coerce').fillna(0.0).astype(float),
+            price=pd.to_numeric(df['price'], errors='coerce').fillna(0.0).astype(float)
+        )
     
     def _establish_db_connection(self):
         """Establish database connection to Supabase"""
+        # A transaction pooler returns the backend to the pool with any named
+        # prepared statement still defined, so disable them there
+        options = {'prepare_threshold': None} if self._uses_transaction_pooler() else {}
         try:
             # If a direct connection URL is provided, use it (preferred method for Supabase)
             if SUPABASE_URL:
-                self.connection = psycopg2.connect(SUPABASE_URL)
+                self.connection = psycopg.connect(SUPABASE_URL, **options)
             else:
                 # Otherwise use individual parameters
-                self.connection = psycopg2.connect(
+                self.connection = psycopg.connect(
                     host=SUPABASE_HOST,
                     user=SUPABASE_USER,
                     password=SUPABASE_PASSWORD,
-                    database=SUPABASE_DATABASE,
-                    port=SUPABASE_PORT
+                    dbname=SUPABASE_DATABASE,
+                    port=SUPABASE_PORT,
+                    **options
                 )
             self.connection.autocommit = False
             print("Supabase connection established")
         except Error as e:
             raise Error(f"Connection to Supabase failed: {e}")
     
-    def _create_table_if_not_exists(self):
+    def _uses_transaction_pooler(self) -> bool:
+        """Whether the configured connection goes through Supabase's transaction pooler"""
+        port = conninfo_to_dict(SUPABASE_URL).get('port') if SUPABASE_URL else SUPABASE_PORT
+        return str(port) == str(SUPABASE_POOLER_PORT)
+    
+    def _configure_load_transaction(self, cursor: psycopg.Cursor):
+        """Tune session settings for the duration of the single load transaction"""
+        try:
+            # Don't wait for the WAL flush on commit; earlier transactions stay durable
+            cursor.execute("SET LOCAL synchronous_commit = off")
+            cursor.execute("SET LOCAL work_mem = '64MB'")
+        except Error as e:
+            raise Error(f"Transaction setup failed: {e}")
+    
+    def _create_table_if_not_exists(self, cursor: psycopg.Cursor):
         """Create table if it doesn't exist"""
+        if _table_verified:
+            return
+        
         create_table_query = """
         CREATE TABLE IF NOT EXISTS insider_transactions (
             id SERIAL PRIMARY KEY,
@@ -182,57 +345,135 @@ class ETLPipeline:
             type VARCHAR(50),
             transaction VARCHAR(50),
             shares DECIMAL(10, 2),
-            price DECIMAL(10, 2) NOT NULL DEFAULT 0.00,
-            UNIQUE (symbol, date, executive, shares, price)
+            price DECIMAL(10, 2) NOT NULL DEFAULT 0.00
         ) 
         """
-        cursor = self.connection.cursor()
+        # Explicit upsert key; price is excluded so float prices never take part in equality
+        create_index_query = """
+        CREATE UNIQUE INDEX IF NOT EXISTS insider_transactions_upsert_key
+        ON insider_transactions (symbol, date, executive, shares)
+        """
+        # Tables created with the old (symbol, date, executive, shares, price) key may
+        # hold rows differing only in price; keep the newest of each before indexing
+        dedupe_query = """
+        DELETE FROM insider_transactions old
+        USING insider_transactions newer
+        WHERE old.symbol = newer.symbol
+          AND old.date = newer.date
+          AND old.executive = newer.executive
+          AND old.shares = newer.shares
+          AND old.id < newer.id
+        """
+        old_key_query = """
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'insider_transactions_symbol_date_executive_shares_price_key'
+        """
+        drop_old_key_query = """
+        ALTER TABLE insider_transactions
+        DROP CONSTRAINT IF EXISTS insider_transactions_symbol_date_executive_shares_price_key
+        """
         try:
             cursor.execute(create_table_query)
+            cursor.execute("SELECT to_regclass('insider_transactions_upsert_key')")
+            if cursor.fetchone()[0] is None:
+                cursor.execute(dedupe_query)
+                if cursor.rowcount > 0:
+                    print(f"Removed {cursor.rowcount} rows duplicated under the new upsert key")
+                cursor.execute(create_index_query)
+            cursor.execute(old_key_query)
+            if cursor.fetchone() is not None:
+                cursor.execute(drop_old_key_query)
             print("Table verified/created")
         except Error as e:
             raise Error(f"Table creation failed: {e}")
-        finally:
-            cursor.close()
     
-    def _insert_data_to_db(self, df: pd.DataFrame):
+    def _pipeline(self):
+        """Enter libpq pipeline mode when available (libpq >= 14), else run unpipelined"""
+        if psycopg.pq.version() >= 140000:
+            return self.connection.pipeline()
+        return nullcontext()
+    
+    def _insert_data_to_db(self, cursor: psycopg.Cursor):
         """Insert data into PostgreSQL with duplicate handling"""
+        # Rows are streamed from processed_data without an intermediate copy. Duplicate
+        # keys are safe: executemany upserts row by row and the COPY merge dedupes in SQL
+        data = self.processed_data
+        
+        if len(data) > BULK_LOAD_THRESHOLD:
+            self._copy_data_to_db(cursor, data)
+            return
+        
         insert_query = """
         INSERT INTO insider_transactions 
         (symbol, date, executive, title, type, transaction, shares, price)
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (symbol, date, executive, shares, price) DO UPDATE SET 
+        ON CONFLICT (symbol, date, executive, shares) DO UPDATE SET 
             title = EXCLUDED.title,
             type = EXCLUDED.type,
-            transaction = EXCLUDED.transaction
+            transaction = EXCLUDED.transaction,
+            price = EXCLUDED.price
         """
-        data = [(
-            row['symbol'],
-            row['date'],
-            row['executive'],
-            row['title'],
-            row['type'],
-            row['transaction'],
-            row['shares'],
-            row['price']
-        ) for _, row in df.iterrows()]
         
-        cursor = self.connection.cursor()
         try:
-            cursor.executemany(insert_query, data)
-            self.connection.commit()
-            print(f"Successfully inserted/updated {cursor.rowcount} records")
+            # In pipeline mode executemany streams every Bind/Execute before a single
+            # Sync; it also prepares the statement server-side unless the pooler forbids it
+            with self._pipeline():
+                cursor.executemany(insert_query, data)
+            print(f"Successfully inserted/updated {len(data)} records")
         except Error as e:
-            self.connection.rollback()
             raise Error(f"Insert failed: {e}")
-        finally:
-            cursor.close()
     
-    def _save_to_csv(self, df: pd.DataFrame):
+    def _copy_data_to_db(self, cursor: psycopg.Cursor, data: List[Tuple]):
+        """Bulk load data through a temp table with COPY, then upsert in one statement"""
+        try:
+            cursor.execute("""
+                CREATE TEMP TABLE tmp_ins (
+                    symbol VARCHAR(10) NOT NULL,
+                    date DATE NOT NULL,
+                    executive VARCHAR(100),
+                    title VARCHAR(100),
+                    type VARCHAR(50),
+                    transaction VARCHAR(50),
+                    shares DECIMAL(10, 2),
+                    price DECIMAL(10, 2) NOT NULL DEFAULT 0.00
+                ) ON COMMIT DROP
+            """)
+            with cursor.copy("""
+                COPY tmp_ins (symbol, date, executive, title, type, transaction, shares, price)
+                FROM STDIN
+            """) as copy:
+                for row in data:
+                    copy.write_row(row)
+            cursor.execute("""
+                INSERT INTO insider_transactions 
+                (symbol, date, executive, title, type, transaction, shares, price)
+                SELECT DISTINCT ON (symbol, date, executive, shares)
+                    symbol, date, executive, title, type, transaction, shares, price
+                FROM tmp_ins
+                -- Keys are compared after DECIMAL rounding, so dedupe here; in a freshly
+                -- COPYed temp table ctid follows input order, keeping the last row
+                ORDER BY symbol, date, executive, shares, ctid DESC
+                ON CONFLICT (symbol, date, executive, shares) DO UPDATE SET 
+                    title = EXCLUDED.title,
+                    type = EXCLUDED.type,
+                    transaction = EXCLUDED.transaction,
+                    price = EXCLUDED.price
+            """)
+            loaded = cursor.rowcount
+            # Refresh planner stats after a large load so later upserts plan against them
+            cursor.execute("ANALYZE insider_transactions")
+            print(f"Successfully bulk loaded {loaded} records")
+        except Error as e:
+            raise Error(f"Bulk load failed: {e}")
+    
+    def _save_to_csv(self):
         """Save processed data to CSV"""
         timestamp = datetime.now().strftime('%Y%m%d_%H%M')
         csv_filename = f'insider_transactions_{timestamp}.csv'
-        df.to_csv(csv_filename, index=False)
+        with open(csv_filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            writer.writerows(self.processed_data)
         print(f"Data backup saved to {csv_filename}")
     
     def _close_db_connection(self):
@@ -1,13 +1,16 @@
 import os
+import csv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import time
-import json
+import orjson
 import dotenv
 from datetime import datetime
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2 import Error
+import psycopg
+from psycopg import Error
 from typing import Optional, Dict, List
 
 # Load environment variables
@@ -22,10 +25,15 @@ SUPABASE_PASSWORD = os.getenv('SUPABASE_PASSWORD')
 SUPABASE_PORT = int(os.getenv('SUPABASE_PORT', 6543))  # Use 6543 for connection pooling
 SUPABASE_URL = os.getenv('SUPABASE_URL')  # Direct connection URL
 BASE_URL = 'https://www.alphavantage.co/query'
+REQUEST_TIMEOUT = (3.05, 27)  # (connect, read) seconds
+_tables_verified = False  # DDL only needs to run once per process
+COLUMNS = ['ticker', 'price', 'change_amount', 'change_percentage',
+           'volume', 'category', 'last_updated']
 
 class StockMarketETL:
     def __init__(self):
         self.connection = None
+        self.session = self._create_http_session()
         self.raw_data = {}
         self.processed_data = {
             'gainers': [],
@@ -86,7 +94,8 @@ class StockMarketETL:
             return False
     
     def load(self) -> bool:
-        """Load data into Supabase"""
+        """Load data into Supabase in a single transaction"""
+        global _tables_verified
         print("\n=== LOADING PHASE ===")
         if not self.processed_data:
             print("No data to load")
@@ -94,25 +103,43 @@ class StockMarketETL:
         
         try:
             self._establish_db_connection()
-            self._create_tables_if_not_exists()
             
-            # Load metadata
-            self._load_metadata()
+            # One cursor for the whole load phase
+            with self.connection.cursor() as cursor:
+                self._configure_load_transaction(cursor)
+                self._create_tables_if_not_exists(cursor)
+                
+                # Load metadata
+                self._load_metadata(cursor)
+                
+                # Load stock data for each category
+                for category in ['gainers', 'losers', 'active']:
+                    df = pd.DataFrame(self.processed_data[category])
+                    self._insert_stock_data(cursor, df, category)
             
-            # Load stock data for each category
-            for category in ['gainers', 'losers', 'active']:
-                df = pd.DataFrame(self.processed_data[category])
-                self._insert_stock_data(df, category)
+            # Metadata and all categories are replaced atomically
+            self.connection.commit()
+            _tables_verified = True
+            print("Stock data committed")
             
             self._save_to_csv()
             return True
             
         except Error as e:
+            if self.connection and not self.connection.closed:
+                self.connection.rollback()
             print(f"Database error: {e}")
             return False
         finally:
             self._close_db_connection()
     
+    def _create_http_session(self) -> requests.Session:
+        """Create a pooled HTTP session that retries throttled/failed requests"""
+        session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 502, 503, 504])
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=retries))
+        return session
+    
     def _fetch_api_data(self) -> Optional[Dict]:
         """Fetch top gainers/losers/active data from API"""
         try:
@@ -120,10 +147,10 @@ class StockMarketETL:
                 'function': 'TOP_GAINERS_LOSERS',
                 'apikey': API_KEY
             }
-            response = requests.get(BASE_URL, params=params)
+            response = self.session.get(BASE_URL, params=params, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             print(f"API Error: {e}")
             return None
     
@@ -135,7 +162,7 @@ class StockMarketETL:
                 'price': self._safe_float(item.get('price')),
                 'change_amount': self._safe_float(item.get('change_amount')),
                 'change_percentage': self._safe_float(item.get('change_percentage', '').replace('%', '')),
-                'volume': self._safe_float(item.get('volume'), 0),
+                'volume': int(self._safe_float(item.get('volume'), 0)),  # BIGINT column
                 'category': category,
                 'last_updated': self.raw_data.get('last_updated')
             }
@@ -153,17 +180,29 @@ class StockMarketETL:
     def _establish_db_connection(self):
         """Establish database connection to Supabase"""
         try:
-            # Use only the connection string from environment
-            self.connection = psycopg2.connect(SUPABASE_URL)
+            # Use only the connection string from environment. It normally points at
+            # the transaction pooler, which hands the backend to other clients with
+            # any named prepared statement still defined, so never prepare
+            self.connection = psycopg.connect(SUPABASE_URL, prepare_threshold=None)
             self.connection.autocommit = False
             print("Supabase connection established")
         except Error as e:
             print(f"Connection details used: {SUPABASE_URL}")  # Debug output
             raise Error(f"Connection to Supabase failed: {e}")
     
-    def _create_tables_if_not_exists(self):
+    def _configure_load_transaction(self, cursor: psycopg.Cursor):
+        """Tune session settings for the duration of the single load transaction"""
+        try:
+            # Don't wait for the WAL flush on commit; earlier transactions stay durable
+            cursor.execute("SET LOCAL synchronous_commit = off")
+            cursor.execute("SET LOCAL work_mem = '64MB'")
+        except Error as e:
+            raise Error(f"Transaction setup failed: {e}")
+    
+    def _create_tables_if_not_exists(self, cursor: psycopg.Cursor):
         """Create tables if they don't exist"""
-        cursor = self.connection.cursor()
+        if _tables_verified:
+            return
         
         try:
             # Metadata table
@@ -194,14 +233,10 @@ class StockMarketETL:
             print("Tables verified/created")
         except Error as e:
             raise Error(f"Table creation failed: {e}")
-        finally:
-            cursor.close()
     
-    def _load_metadata(self):
+    def _load_metadata(self, cursor: psycopg.Cursor):
         """Load metadata into database"""
         metadata = self.processed_data['metadata']
-        cursor = self.connection.cursor()
-        
         try:
             cursor.execute("""
                 INSERT INTO stock_metadata (last_updated, description)
@@ -213,18 +248,12 @@ class StockMarketETL:
                 metadata['description']
             ))
             
-            self.connection.commit()
             print("Metadata loaded successfully")
         except Error as e:
-            self.connection.rollback()
             raise Error(f"Metadata insert failed: {e}")
-        finally:
-            cursor.close()
     
-    def _insert_stock_data(self, df: pd.DataFrame, category: str):
-        """Insert stock data into database"""
-        cursor = self.connection.cursor()
-        
+    def _insert_stock_data(self, cursor: psycopg.Cursor, df: pd.DataFrame, category: str):
+        """Replace a category's rows using COPY; the caller commits"""
         try:
             # Delete old data for this category to prevent duplicates
             cursor.execute("""
@@ -232,40 +261,32 @@ class StockMarketETL:
                 WHERE category = %s
             """, (category,))
             
-            # Insert new data
-            for _, row in df.iterrows():
-                cursor.execute("""
-                    INSERT INTO stock_movers (
+            # Stream new data in one COPY
+            if not df.empty:
+                with cursor.copy("""
+                    COPY stock_movers (
                         ticker, price, change_amount, 
                         change_percentage, volume, category, last_updated
                     )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    row['ticker'],
-                    row['price'],
-                    row['change_amount'],
-                    row['change_percentage'],
-                    row['volume'],
-                    row['category'],
-                    row['last_updated']
-                ))
+                    FROM STDIN
+                """) as copy:
+                    for row in df[COLUMNS].itertuples(index=False, name=None):
+                        copy.write_row(row)
             
-            self.connection.commit()
             print(f"Successfully loaded {len(df)} {category} records")
         except Error as e:
-            self.connection.rollback()
             raise Error(f"Stock data insert failed: {e}")
-        finally:
-            cursor.close()
     
     def _save_to_csv(self):
         """Save processed data to CSV files"""
         timestamp = datetime.now().strftime('%Y%m%d_%H%M')
         
         for category in ['gainers', 'losers', 'active']:
-            df = pd.DataFrame(self.processed_data[category])
             filename = f'stock_{category}_{timestamp}.csv'
-            df.to_csv(filename, index=False)
+            with open(filename, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=COLUMNS)
+                writer.writeheader()
+                writer.writerows(self.processed_data[category])
             print(f"Saved {category} data to {filename}")
     
     def _close_db_connection(self):